@@ -1,37 +1,68 @@
 """Stream context data structures for real-time message streaming."""
 
+import time
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional
 from datetime import datetime
 from telegram import Message
 
 
-@dataclass
+@dataclass(slots=True)
 class StreamMessage:
     """Represents a message in the stream."""
     
     message_id: int
     message_type: str  # 'header', 'content', 'tool', 'status'
-    content: str
+    content_parts: List[str]  # Joined lazily, see the content property
     telegram_message: Optional[Message] = None
     created_at: datetime = field(default_factory=datetime.now)
     last_updated: datetime = field(default_factory=datetime.now)
-    is_final: bool = False
+    stream_context: Optional["StreamContext"] = field(default=None, repr=False, compare=False)
+    generation: int = field(default=0, repr=False, compare=False)
+    # Text Telegram last confirmed; content may be ahead while an edit is pending
+    sent_content: Optional[str] = field(default=None, repr=False, compare=False)
+    
+    @property
+    def content(self) -> str:
+        """Full message text; appended parts are joined once, on first read."""
+        parts = self.content_parts
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+    
+    @property
+    def is_final(self) -> bool:
+        """Whether the stream this message belongs to has finished."""
+        context = self.stream_context
+        if context is None:
+            return False
+        # A context reused for a later session has moved to a new generation
+        return context._all_final or context._generation != self.generation
     
     def update_content(self, new_content: str) -> None:
         """Update message content and timestamp."""
-        self.content = new_content
+        self.content_parts = [new_content]
+        self.last_updated = datetime.now()
+    
+    def append_content(self, chunk: str) -> None:
+        """Append text to the message without rebuilding the whole content."""
+        self.content_parts.append(chunk)
         self.last_updated = datetime.now()
+    
+    def content_matches(self, text: str) -> bool:
+        """Check whether the message content is already the given text."""
+        # str equality compares lengths before contents, so mismatches are cheap
+        return text == self.content
 
 
-@dataclass
+@dataclass(slots=True)
 class ToolExecution:
     """Tracks tool execution status."""
     
     tool_name: str
     status: str  # 'started', 'in_progress', 'completed', 'error'
-    start_time: datetime = field(default_factory=datetime.now)
-    end_time: Optional[datetime] = None
+    start_ns: int = field(default_factory=time.monotonic_ns)
+    end_ns: Optional[int] = None
     execution_time_ms: Optional[int] = None
     error_message: Optional[str] = None
     message_id: Optional[int] = None
@@ -39,31 +70,33 @@ class ToolExecution:
     @property
     def duration_ms(self) -> Optional[int]:
         """Calculate duration in milliseconds."""
-        if self.end_time and self.start_time:
-            return int((self.end_time - self.start_time).total_seconds() * 1000)
+        if self.end_ns is not None:
+            return (self.end_ns - self.start_ns) // 1_000_000
         return None
     
     def complete(self, success: bool = True, error: Optional[str] = None) -> None:
         """Mark tool execution as complete."""
-        self.end_time = datetime.now()
+        self.end_ns = time.monotonic_ns()
         self.execution_time_ms = self.duration_ms
         self.status = 'completed' if success else 'error'
         if error:
             self.error_message = error
 
 
-@dataclass
+@dataclass(slots=True)
 class StreamContext:
     """Manages the context for a streaming Claude session."""
     
     user_id: int
     chat_id: int
     session_id: Optional[str] = None
-    messages: Dict[str, StreamMessage] = field(default_factory=dict)
+    messages: List[StreamMessage] = field(default_factory=list)  # Index is message_id - 1
     tools: Dict[str, ToolExecution] = field(default_factory=dict)
-    content_buffer: str = ""
+    content_buffer: bytearray = field(default_factory=bytearray)  # UTF-8 bytes
+    _read_offset: int = field(default=0, repr=False)  # Start of unread bytes
     total_cost: float = 0.0
     start_time: datetime = field(default_factory=datetime.now)
+    start_monotonic: float = field(default_factory=time.monotonic, repr=False)
     is_active: bool = True
     
     # Message tracking
@@ -76,6 +109,40 @@ class StreamContext:
     update_interval_ms: int = 1000
     max_messages: int = 10
     
+    _latest_by_type: Dict[str, StreamMessage] = field(default_factory=dict, repr=False)
+    _all_final: bool = field(default=False, repr=False)
+    _generation: int = field(default=0, repr=False)  # Bumped on every reset
+    
+    @property
+    def generation(self) -> int:
+        """Number of times the context has been reset for a new session."""
+        return self._generation
+    
+    def reset(self, user_id: int, chat_id: int, session_id: Optional[str] = None,
+              chunk_size: int = 500, update_interval_ms: int = 1000,
+              max_messages: int = 10) -> None:
+        """Reinitialize the context in place for a new session."""
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.session_id = session_id
+        self.messages.clear()
+        self.tools.clear()
+        self.content_buffer.clear()
+        self._read_offset = 0
+        self.total_cost = 0.0
+        self.start_time = datetime.now()
+        self.start_monotonic = time.monotonic()
+        self.is_active = True
+        self.header_message_id = None
+        self.content_message_id = None
+        self.status_message_id = None
+        self.chunk_size = chunk_size
+        self.update_interval_ms = update_interval_ms
+        self.max_messages = max_messages
+        self._latest_by_type.clear()
+        self._all_final = False
+        self._generation += 1
+    
     def add_message(self, message_type: str, content: str, 
                    telegram_message: Optional[Message] = None) -> StreamMessage:
         """Add a new stream message."""
@@ -83,10 +150,14 @@ class StreamContext:
         stream_msg = StreamMessage(
             message_id=message_id,
             message_type=message_type,
-            content=content,
-            telegram_message=telegram_message
+            content_parts=[content],
+            telegram_message=telegram_message,
+            stream_context=self,
+            generation=self._generation,
+            sent_content=content if telegram_message is not None else None
         )
-        self.messages[f"{message_type}_{message_id}"] = stream_msg
+        self.messages.append(stream_msg)
+        self._latest_by_type[message_type] = stream_msg
         
         # Track specific message types
         if message_type == 'header':
@@ -101,12 +172,18 @@ class StreamContext:
     def get_message(self, message_type: str, message_id: Optional[int] = None) -> Optional[StreamMessage]:
         """Get a message by type and optional ID."""
         if message_id:
-            return self.messages.get(f"{message_type}_{message_id}")
+            stream_msg = self.get_message_by_id(message_id)
+            if stream_msg and stream_msg.message_type == message_type:
+                return stream_msg
+            return None
         
         # Return the latest message of this type
-        for key, msg in reversed(self.messages.items()):
-            if msg.message_type == message_type:
-                return msg
+        return self._latest_by_type.get(message_type)
+    
+    def get_message_by_id(self, message_id: int) -> Optional[StreamMessage]:
+        """Get a message by ID regardless of its type."""
+        if 0 < message_id <= len(self.messages):
+            return self.messages[message_id - 1]
         return None
     
     def start_tool(self, tool_name: str) -> ToolExecution:
@@ -125,29 +202,67 @@ class StreamContext:
     
     def append_content(self, new_content: str) -> None:
         """Append content to the buffer."""
-        self.content_buffer += new_content
+        self.content_buffer.extend(new_content.encode('utf-8'))
+    
+    def has_buffer_chunk(self) -> bool:
+        """Check whether a full chunk of content is buffered."""
+        return len(self.content_buffer) - self._read_offset >= self.chunk_size
     
     def get_buffer_chunk(self) -> Optional[str]:
         """Get a chunk of content from the buffer."""
-        if len(self.content_buffer) >= self.chunk_size:
-            chunk = self.content_buffer[:self.chunk_size]
-            self.content_buffer = self.content_buffer[self.chunk_size:]
-            return chunk
-        return None
+        if not self.has_buffer_chunk():
+            return None
+        
+        start = self._read_offset
+        
+        end = self._char_boundary(start, start + self.chunk_size)
+        with memoryview(self.content_buffer) as view:
+            chunk = str(view[start:end], 'utf-8')
+        self._read_offset = end
+        
+        # Drop consumed bytes only once they make up most of the buffer, so
+        # the remaining bytes are moved rarely
+        if end * 2 > len(self.content_buffer):
+            del self.content_buffer[:end]
+            self._read_offset = 0
+        return chunk
     
     def flush_buffer(self) -> str:
         """Get all remaining content from buffer."""
-        content = self.content_buffer
-        self.content_buffer = ""
+        with memoryview(self.content_buffer) as view:
+            content = str(view[self._read_offset:], 'utf-8')
+        self.content_buffer.clear()
+        self._read_offset = 0
         return content
     
+    def _char_boundary(self, start: int, end: int) -> int:
+        """Move a byte offset so it doesn't split a multi-byte UTF-8 character."""
+        buffer = self.content_buffer
+        size = len(buffer)
+        
+        # Continuation bytes look like 0b10xxxxxx; the partial character
+        # stays in the buffer for the next chunk
+        boundary = end
+        while start < boundary < size and buffer[boundary] & 0xC0 == 0x80:
+            boundary -= 1
+        if boundary > start:
+            return boundary
+        
+        # Chunk is smaller than a single character, take the whole character
+        while end < size and buffer[end] & 0xC0 == 0x80:
+            end += 1
+        return end
+    
+    def elapsed_seconds(self) -> float:
+        """Get the time since the session started, from the monotonic clock."""
+        return time.monotonic() - self.start_monotonic
+    
     def get_session_summary(self) -> Dict:
         """Get a summary of the streaming session."""
-        duration = datetime.now() - self.start_time
         return {
             'session_id': self.session_id,
             'user_id': self.user_id,
-            'duration_seconds': duration.total_seconds(),
+            'duration_seconds': self.elapsed_seconds(),
             'total_messages': len(self.messages),
             'tools_used': len(self.tools),
             'total_cost': self.total_cost,
@@ -158,6 +273,5 @@ class StreamContext:
         """Mark session as inactive and prepare for cleanup."""
         self.is_active = False
         
-        # Mark all messages as final
-        for msg in self.messages.values():
-            msg.is_final = True
\ No newline at end of file
+        # Messages read this flag, so all of them become final at once
+        self._all_final = True
\ No newline at end of file
@@ -1,27 +1,61 @@
 """Message manager for handling multi-message streaming and organization."""
 
 import asyncio
-from typing import Dict, List, Optional, Any, Callable
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Callable, Tuple
 from datetime import datetime, timedelta
 
 import structlog
 from telegram import Update, Message, InlineKeyboardMarkup
-from telegram.error import TelegramError, BadRequest
+from telegram.error import TelegramError, BadRequest, RetryAfter
 
+from ...security.rate_limiter import RateLimitBucket
 from ..models.stream_context import StreamContext, StreamMessage
-from .streaming import StreamProcessor
+from .streaming import StreamProcessor, escape_markdown
 
 logger = structlog.get_logger()
 
 
+def _create_bucket(rate: int) -> RateLimitBucket:
+    """Create a full token bucket refilling at the given rate per second."""
+    return RateLimitBucket(
+        capacity=rate,
+        tokens=rate,
+        last_update=datetime.utcnow(),
+        refill_rate=rate
+    )
+
+
 class MessageManager:
     """Manages multiple messages for streaming Claude responses."""
     
+    # Oldest queued updates are dropped once a user's queue is full
+    MAX_PENDING_UPDATES = 256
+    
+    # Telegram allows about 30 messages per second overall and 1 per second per chat
+    GLOBAL_UPDATES_PER_SECOND = 30
+    CHAT_UPDATES_PER_SECOND = 1
+    MAX_CONCURRENT_UPDATES = 10
+    
+    # Shared by every manager in the process: the bot creates a manager per
+    # message, while Telegram's limits apply to the bot as a whole
+    _global_bucket = _create_bucket(GLOBAL_UPDATES_PER_SECOND)
+    _chat_buckets: Dict[int, RateLimitBucket] = {}
+    
+    _FILE_TOOLS = frozenset(('read', 'write', 'edit'))
+    MAX_COMMAND_PREVIEW = 50
+    
     def __init__(self, stream_processor: StreamProcessor):
         """Initialize message manager."""
         self.stream_processor = stream_processor
-        self.pending_updates: Dict[int, List[Dict]] = {}  # user_id -> list of pending updates
-        self.update_tasks: Dict[int, asyncio.Task] = {}  # user_id -> update task
+        # user_id -> latest pending update per stream message, oldest first
+        self.pending_updates: Dict[int, "OrderedDict[int, Dict]"] = {}
+        
+        # One dispatcher sends this manager's queued updates within the shared
+        # rate limits; it is started when an update is queued and exits once
+        # the queues are drained
+        self._dispatcher_task: Optional[asyncio.Task] = None
+        self._updates_available = asyncio.Event()
         
     async def start_streaming_response(self, update: Update, user_id: int, 
                                      session_id: Optional[str] = None) -> StreamContext:
@@ -36,9 +70,6 @@ class MessageManager:
                 session_id=session_id
             )
             
-            # Start the update processing task for this user
-            self._start_update_task(user_id)
-            
             return context
             
         except Exception as e:
@@ -82,9 +113,10 @@ class MessageManager:
             return telegram_msg
             
         except BadRequest as e:
-            if "can't parse entities" in str(e).lower():
+            error = str(e)
+            if "can't parse entities" in error.lower():
                 # Fallback to plain text if markdown parsing fails
-                logger.warning("Markdown parsing failed, sending as plain text", error=str(e))
+                logger.warning("Markdown parsing failed, sending as plain text", error=error)
                 try:
                     telegram_msg = await bot.send_message(
                         chat_id=context.chat_id,
@@ -97,7 +129,7 @@ class MessageManager:
                     logger.error("Failed to send even plain text message", error=str(fallback_e))
                     return None
             else:
-                logger.error("Telegram API error", user_id=user_id, error=str(e))
+                logger.error("Telegram API error", user_id=user_id, error=error)
                 return None
         except Exception as e:
             logger.error("Failed to send stream message", user_id=user_id, error=str(e))
@@ -121,6 +153,12 @@ class MessageManager:
             )
             return False
         
+        self._queue_stream_message_update(user_id, stream_msg, new_content, parse_mode)
+        return True
+    
+    def _queue_stream_message_update(self, user_id: int, stream_msg: StreamMessage,
+                                     new_content: str, parse_mode: str = "Markdown") -> None:
+        """Queue an update for a stream message the caller already holds."""
         # Queue the update instead of doing it immediately to handle rate limits
         self._queue_message_update(user_id, {
             'action': 'update',
@@ -128,13 +166,11 @@ class MessageManager:
             'new_content': new_content,
             'parse_mode': parse_mode
         })
-        
-        return True
     
     async def handle_tool_start(self, user_id: int, tool_name: str, 
                               tool_input: Optional[Dict] = None) -> None:
         """Handle the start of a tool execution."""
-        escaped_tool_name = self._escape_markdown(tool_name)
+        escaped_tool_name = escape_markdown(tool_name)
         tool_text = f"🔧 *Using {escaped_tool_name}*"
         
         # Add tool input information if available
@@ -163,18 +199,17 @@ class MessageManager:
             return
         
         # Update the tool message
-        status_emoji = "❌" if not success else "✅"
-        duration_text = f" ({execution_time_ms}ms)" if execution_time_ms else ""
-        escaped_tool_name = self._escape_markdown(tool_name)
-        
-        if not success:
-            updated_text = f"{status_emoji} *{escaped_tool_name} failed*{duration_text}"
-            if error:
-                error_preview = error[:100] + "..." if len(error) > 100 else error
-                escaped_error = self._escape_markdown(error_preview)
-                updated_text += f"\n`{escaped_error}`"
-        else:
-            updated_text = f"{status_emoji} *{escaped_tool_name} complete*{duration_text}"
+        parts = [
+            "✅ *" if success else "❌ *",
+            escape_markdown(tool_name),
+            " complete*" if success else " failed*",
+        ]
+        if execution_time_ms:
+            parts.append(f" ({execution_time_ms}ms)")
+        if not success and error:
+            error_preview = error if len(error) <= 100 else error[:100] + "..."
+            parts += ["\n`", escape_markdown(error_preview), "`"]
+        updated_text = "".join(parts)
         
         await self.update_stream_message(
             user_id, tool_exec.message_id, updated_text, 'tool'
@@ -194,7 +229,7 @@ class MessageManager:
         
         if content_msg:
             # Update existing content message with rate limiting
-            self._queue_content_update(user_id, context)
+            self._queue_content_update(user_id, context, content_msg)
         else:
             # Create new content message
             initial_content = f"🤖 *Claude Response:*\n\n{content_chunk}"
@@ -215,27 +250,29 @@ class MessageManager:
             remaining_content = context.flush_buffer()
             if remaining_content:
                 content_msg = context.get_message('content')
-                if content_msg:
-                    final_content = content_msg.content + remaining_content
-                    await self.update_stream_message(
-                        user_id, content_msg.message_id, final_content, 'content'
-                    )
+                if content_msg and content_msg.telegram_message:
+                    # Sent directly: cleanup below drops anything still queued
+                    await self._send_final_update(context.chat_id, {
+                        'action': 'update_content',
+                        'stream_msg': content_msg,
+                        'new_content': content_msg.content + remaining_content,
+                        'parse_mode': 'Markdown'
+                    })
             
             # Send completion message
             await self._send_completion_message(context, cost, follow_up_suggestions)
             
-            # Clean up
-            await self._cleanup_user_streaming(user_id)
-            
         except Exception as e:
             logger.error("Failed to finalize stream", user_id=user_id, error=str(e))
+        finally:
+            # Release the stream even if finishing it failed
+            await self._cleanup_user_streaming(user_id)
     
     async def _send_completion_message(self, context: StreamContext, cost: float,
                                      follow_up_suggestions: Optional[List[str]]) -> None:
         """Send the completion status message."""
         tools_count = len(context.tools)
-        duration = datetime.now() - context.start_time
-        duration_text = f"{duration.total_seconds():.1f}s"
+        duration_text = f"{context.elapsed_seconds():.1f}s"
         
         status_text = f"✅ *Session Complete*"
         status_text += f"\n💰 Cost: ${cost:.4f}"
@@ -247,7 +284,6 @@ class MessageManager:
         # Add follow-up suggestions if available
         reply_markup = None
         if follow_up_suggestions:
-            from .formatting import ResponseFormatter
             # This would create suggestion buttons - simplified for now
             status_text += "\n\n💡 *What would you like to do next?*"
         
@@ -256,22 +292,49 @@ class MessageManager:
         )
     
     def _queue_message_update(self, user_id: int, update_data: Dict) -> None:
-        """Queue a message update to handle rate limiting."""
-        if user_id not in self.pending_updates:
-            self.pending_updates[user_id] = []
+        """Queue a message update to handle rate limiting.
         
-        self.pending_updates[user_id].append(update_data)
-    
-    def _queue_content_update(self, user_id: int, context: StreamContext) -> None:
-        """Queue a content update with rate limiting."""
-        content_msg = context.get_message('content')
-        if not content_msg:
+        Only the latest update for each message is kept; an update for a
+        message that is already queued replaces the older payload.
+        """
+        stream_msg = update_data['stream_msg']
+        key = id(stream_msg)
+        
+        # Editing a message to the text it already shows is a wasted API call
+        if stream_msg.content_matches(update_data['new_content']):
+            updates = self.pending_updates.get(user_id)
+            if updates:
+                updates.pop(key, None)
+                if not updates:
+                    del self.pending_updates[user_id]
             return
         
+        updates = self.pending_updates.setdefault(user_id, OrderedDict())
+        updates[key] = update_data
+        updates.move_to_end(key)
+        
+        if len(updates) > self.MAX_PENDING_UPDATES:
+            updates.popitem(last=False)
+        
+        self._updates_available.set()
+        self._start_dispatcher()
+    
+    def _pending_content(self, user_id: int, stream_msg: StreamMessage) -> str:
+        """Get the content a message will have once queued updates are applied."""
+        updates = self.pending_updates.get(user_id)
+        if updates:
+            update_data = updates.get(id(stream_msg))
+            if update_data:
+                return update_data['new_content']
+        return stream_msg.content
+    
+    def _queue_content_update(self, user_id: int, context: StreamContext,
+                              content_msg: StreamMessage) -> None:
+        """Queue a content update with rate limiting."""
         # Get chunk from buffer if available
         chunk = context.get_buffer_chunk()
         if chunk:
-            new_content = content_msg.content + chunk
+            new_content = self._pending_content(user_id, content_msg) + chunk
             self._queue_message_update(user_id, {
                 'action': 'update_content',
                 'stream_msg': content_msg,
@@ -279,45 +342,151 @@ class MessageManager:
                 'parse_mode': 'Markdown'
             })
     
-    def _start_update_task(self, user_id: int) -> None:
-        """Start the background task for processing updates."""
-        if user_id in self.update_tasks:
-            # Cancel existing task
-            self.update_tasks[user_id].cancel()
+    def _get_chat_bucket(self, chat_id: int) -> RateLimitBucket:
+        """Get the per-chat token bucket."""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _create_bucket(self.CHAT_UPDATES_PER_SECOND)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+    
+    def _prune_chat_buckets(self) -> None:
+        """Forget chat buckets that have refilled to capacity.
+        
+        A full bucket behaves exactly like a newly created one, so dropping it
+        loses nothing and keeps the shared dict from growing with every chat.
+        """
+        full = [
+            chat_id for chat_id, bucket in self._chat_buckets.items()
+            if bucket.get_wait_time(bucket.capacity) == 0
+        ]
+        for chat_id in full:
+            del self._chat_buckets[chat_id]
+    
+    def _get_chat_id(self, user_id: int) -> int:
+        """Get the chat a user's updates are sent to."""
+        context = self.stream_processor.get_stream_context(user_id)
+        return context.chat_id if context else user_id
+    
+    def _start_dispatcher(self) -> None:
+        """Start the background task for dispatching updates."""
+        if self._dispatcher_task and not self._dispatcher_task.done():
+            return
+        
+        self._dispatcher_task = asyncio.create_task(self._dispatch_updates_loop())
+    
+    def _take_ready_updates(self) -> List[Tuple[int, int, Dict]]:
+        """Take at most one update per user that the rate limits allow now."""
+        batch: List[Tuple[int, int, Dict]] = []
+        
+        for user_id in list(self.pending_updates):
+            if len(batch) >= self.MAX_CONCURRENT_UPDATES:
+                break
+            
+            chat_id = self._get_chat_id(user_id)
+            chat_bucket = self._get_chat_bucket(chat_id)
+            if chat_bucket.get_wait_time() > 0:
+                continue
+            if not self._global_bucket.consume():
+                break
+            chat_bucket.consume()
+            
+            updates = self.pending_updates.pop(user_id)
+            _, update_data = updates.popitem(last=False)
+            if updates:
+                # Re-insert at the back so users are served round-robin
+                self.pending_updates[user_id] = updates
+            
+            batch.append((user_id, chat_id, update_data))
         
-        self.update_tasks[user_id] = asyncio.create_task(
-            self._process_updates_loop(user_id)
+        return batch
+    
+    def _next_dispatch_delay(self) -> float:
+        """Get how long to wait before another queued update can be dispatched."""
+        chat_wait = min(
+            self._get_chat_bucket(self._get_chat_id(user_id)).get_wait_time()
+            for user_id in self.pending_updates
         )
+        return max(chat_wait, self._global_bucket.get_wait_time())
     
-    async def _process_updates_loop(self, user_id: int) -> None:
-        """Background loop to process queued updates with rate limiting."""
+    async def _dispatch_updates_loop(self) -> None:
+        """Background loop to dispatch queued updates within rate limits.
+        
+        The loop is never cancelled: it returns once the queues are empty, and
+        cleanup wakes it up so it notices.
+        """
+        loop = asyncio.get_running_loop()
         try:
             while True:
-                await asyncio.sleep(1)  # Update interval
-                
-                if user_id not in self.pending_updates:
-                    continue
-                
-                updates = self.pending_updates[user_id]
-                if not updates:
+                batch = self._take_ready_updates()
+                if batch:
+                    await asyncio.gather(*(
+                        self._dispatch_update(user_id, chat_id, update_data)
+                        for user_id, chat_id, update_data in batch
+                    ))
                     continue
                 
-                # Process one update per loop to respect rate limits
-                update_data = updates.pop(0)
-                
-                try:
-                    await self._process_single_update(update_data)
-                except Exception as e:
-                    logger.warning("Failed to process update", error=str(e))
+                if not self.pending_updates:
+                    break
                 
-                # Clean up empty list
-                if not updates:
-                    del self.pending_updates[user_id]
+                # Sleep until a rate limit allows the next update, or until
+                # new work for another chat arrives. A timer sets the same event
+                # so waking up never needs a wait_for timeout and cancellation
+                self._updates_available.clear()
+                timer = loop.call_later(
+                    self._next_dispatch_delay(), self._updates_available.set
+                )
+                await self._updates_available.wait()
+                timer.cancel()
                     
-        except asyncio.CancelledError:
-            logger.debug("Update task cancelled", user_id=user_id)
         except Exception as e:
-            logger.error("Update loop failed", user_id=user_id, error=str(e))
+            logger.error("Update dispatcher failed", error=str(e))
+    
+    async def _send_final_update(self, chat_id: int, update_data: Dict) -> None:
+        """Send an update right away, waiting out Telegram flood control once."""
+        try:
+            await self._process_single_update(update_data)
+        except RetryAfter as e:
+            retry_after = self._retry_after_seconds(e)
+            logger.warning("Telegram rate limit hit", chat_id=chat_id, retry_after=retry_after)
+            await asyncio.sleep(retry_after)
+            try:
+                await self._process_single_update(update_data)
+            except RetryAfter as retry_e:
+                logger.warning(
+                    "Dropped final update after rate limit",
+                    chat_id=chat_id,
+                    retry_after=self._retry_after_seconds(retry_e)
+                )
+    
+    @staticmethod
+    def _retry_after_seconds(error: RetryAfter) -> float:
+        """Get the wait Telegram requested, in seconds."""
+        retry_after = error.retry_after
+        if isinstance(retry_after, timedelta):
+            return retry_after.total_seconds()
+        return retry_after
+    
+    async def _dispatch_update(self, user_id: int, chat_id: int, 
+                             update_data: Dict) -> None:
+        """Send one queued update, backing off if Telegram throttles us."""
+        try:
+            await self._process_single_update(update_data)
+        except RetryAfter as e:
+            retry_after = self._retry_after_seconds(e)
+            logger.warning("Telegram rate limit hit", chat_id=chat_id, retry_after=retry_after)
+            
+            # Empty the chat bucket for the requested time and retry the update
+            # unless a newer one for the same message was queued meanwhile
+            chat_bucket = self._get_chat_bucket(chat_id)
+            chat_bucket.tokens = chat_bucket.capacity - retry_after * chat_bucket.refill_rate
+            updates = self.pending_updates.get(user_id)
+            if self.stream_processor.get_stream_context(user_id) and (
+                not updates or id(update_data['stream_msg']) not in updates
+            ):
+                self._queue_message_update(user_id, update_data)
+        except Exception as e:
+            logger.warning("Failed to process update", error=str(e))
     
     async def _process_single_update(self, update_data: Dict) -> None:
         """Process a single queued update."""
@@ -326,7 +495,7 @@ class MessageManager:
         new_content = update_data['new_content']
         parse_mode = update_data.get('parse_mode', 'Markdown')
         
-        if not stream_msg.telegram_message:
+        if not stream_msg.telegram_message or stream_msg.content_matches(new_content):
             return
         
         try:
@@ -335,61 +504,67 @@ class MessageManager:
                 parse_mode=parse_mode
             )
             stream_msg.update_content(new_content)
+            stream_msg.sent_content = new_content
             
         except BadRequest as e:
-            if "not modified" in str(e).lower():
+            error = str(e)
+            error_lower = error.lower()
+            if "not modified" in error_lower:
                 # Content is the same, ignore
                 pass
-            elif "can't parse entities" in str(e).lower():
+            elif "can't parse entities" in error_lower:
                 # Fallback to plain text
-                logger.warning("Markdown parsing failed in update, trying plain text", error=str(e))
+                logger.warning("Markdown parsing failed in update, trying plain text", error=error)
                 try:
                     await stream_msg.telegram_message.edit_text(new_content)
                     stream_msg.update_content(new_content)
+                    stream_msg.sent_content = new_content
                 except Exception as fallback_e:
                     logger.warning("Failed to update even as plain text", error=str(fallback_e))
             else:
-                logger.warning("Failed to edit message", error=str(e))
+                logger.warning("Failed to edit message", error=error)
+        except RetryAfter:
+            raise
         except Exception as e:
             logger.warning("Failed to update message", error=str(e))
     
     async def _flush_pending_updates(self, user_id: int) -> None:
         """Flush all pending updates for a user."""
-        updates = self.pending_updates.get(user_id, [])
+        updates = self.pending_updates.pop(user_id, None)
+        if not updates:
+            return
         
-        for update_data in updates:
+        while updates:
             try:
+                _, update_data = updates.popitem(last=False)
                 await self._process_single_update(update_data)
             except Exception as e:
                 logger.warning("Failed to flush update", error=str(e))
-        
-        # Clear pending updates
-        self.pending_updates.pop(user_id, None)
     
     async def _cleanup_user_streaming(self, user_id: int) -> None:
         """Clean up streaming resources for a user."""
-        # Cancel update task
-        if user_id in self.update_tasks:
-            self.update_tasks[user_id].cancel()
-            del self.update_tasks[user_id]
-        
-        # Clear pending updates
+        # Clear pending updates and wake the dispatcher so it can exit if idle
         self.pending_updates.pop(user_id, None)
+        self._updates_available.set()
         
         # Clean up stream context
         await self.stream_processor.cleanup_stream(user_id)
+        self._prune_chat_buckets()
     
     def _format_tool_input(self, tool_name: str, tool_input: Dict) -> Optional[str]:
         """Format tool input for display."""
-        if tool_name.lower() in ['read', 'write', 'edit']:
+        tool = tool_name.lower()
+        if tool in self._FILE_TOOLS:
             file_path = tool_input.get('file_path') or tool_input.get('path')
             if file_path:
                 return f"`{file_path}`"
-        elif tool_name.lower() == 'bash':
+        elif tool == 'bash':
             command = tool_input.get('command', '')
             if command:
                 # Truncate long commands
-                return f"`{command[:50]}...`" if len(command) > 50 else f"`{command}`"
+                if len(command) <= self.MAX_COMMAND_PREVIEW:
+                    return f"`{command}`"
+                return f"`{command[:self.MAX_COMMAND_PREVIEW]}...`"
         
         return None
     
@@ -399,19 +574,9 @@ class MessageManager:
     
     async def handle_error(self, user_id: int, error: str) -> None:
         """Handle streaming errors by sending error message."""
-        escaped_error = self._escape_markdown(error)
+        escaped_error = escape_markdown(error)
         error_text = f"❌ *Streaming Error*\n\n`{escaped_error}`"
         await self.send_stream_message(user_id, 'error', error_text)
         
         # Clean up the stream
         await self._cleanup_user_streaming(user_id)
-    
-    def _escape_markdown(self, text: str) -> str:
-        """Escape special Markdown characters."""
-        if not text:
-            return ""
-        # Escape special markdown characters
-        escape_chars = ['*', '_', '`', '[', ']', '(', ')', '~', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-        for char in escape_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
\ No newline at end of file
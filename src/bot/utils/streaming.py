@@ -1,39 +1,125 @@
 """Core streaming utilities for real-time Claude response streaming."""
 
 import asyncio
+import logging
 import re
 import time
-from typing import Optional, Callable, Any, Dict, List
-from datetime import datetime, timedelta
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Deque, Optional, Callable, Any, Dict, List, Set, Tuple
 
 import structlog
 from telegram import Update, Message
+from telegram.constants import ParseMode
 from telegram.error import TelegramError, BadRequest
 
 from ..models.stream_context import StreamContext, StreamMessage, ToolExecution
 
 logger = structlog.get_logger()
 
+# The stdlib logger that structlog's LoggerFactory binds for this module; its
+# level is what filter_by_level checks, so it tells whether an event is emitted
+_stdlib_logger = logging.getLogger(__name__)
+
+# Parse mode for every message this module sends or edits
+_PARSE_MODE = ParseMode.MARKDOWN
+
+# Characters that must be backslash-escaped in Markdown text
+_MD_ESCAPE_CHARS = frozenset('*_`[]()~>#+-=|{}.!')
+
+# Backslash-escapes every special Markdown character in a single pass
+_MD_ESCAPE = str.maketrans({c: f'\\{c}' for c in _MD_ESCAPE_CHARS})
+_MD_SPECIAL = re.compile('[' + ''.join(map(re.escape, sorted(_MD_ESCAPE_CHARS))) + ']')
+
+
+def escape_markdown(text: str) -> str:
+    """Escape special Markdown characters."""
+    if not text:
+        return ""
+    # Most names have nothing to escape; searching is cheaper than
+    # translating, and a regex substitution is slower than either
+    if not _MD_SPECIAL.search(text):
+        return text
+    return text.translate(_MD_ESCAPE)
+
+
+@dataclass(frozen=True, slots=True)
+class StreamConfig:
+    """Streaming settings resolved once from the application settings."""
+    
+    enable: bool = True
+    chunk_size: int = 500
+    update_interval: int = 1000
+    max_messages: int = 10
+    
+    @classmethod
+    def from_settings(cls, settings: Any) -> "StreamConfig":
+        """Read streaming settings, falling back to defaults when missing."""
+        return cls(
+            enable=getattr(settings, 'enable_streaming_messages', True),
+            chunk_size=getattr(settings, 'stream_chunk_size', 500),
+            update_interval=getattr(settings, 'stream_update_interval', 1000),
+            max_messages=getattr(settings, 'max_stream_messages', 10),
+        )
+
 
 class StreamingError(Exception):
     """Exception raised during streaming operations."""
-    pass
+    
+    __slots__ = ()
 
 
 class StreamProcessor:
     """Processes and manages real-time streaming of Claude responses."""
     
+    # Static message text, so only the varying tail is formatted per event
+    _HEADER_PREFIX = "🚀 *Claude Session Started* • "
+    _COMPLETE_FMT = "✅ **Session Complete** • Cost: ${:.4f} • Duration: {:.1f}s"
+    _TOOLS_USED_FMT = " • {} tools used"
+    _FOLLOW_UP_TEXT = "\n\n💡 **What would you like to do next?**"
+    _TOOL_USE_FMT = "🔧 **Using {}**"
+    _CONTENT_PREFIX = "🤖 **Claude Response:**\n\n"
+    
+    # Edits to the same message within this window are sent as one
+    EDIT_DEBOUNCE_SECONDS = 0.25
+    
+    # Finished contexts kept for reuse, shared by all processors in the process
+    _context_pool: Deque[StreamContext] = deque(maxlen=64)
+    
+    # Active streams are split across this many dicts by user ID; must be a
+    # power of two so the shard is picked with a mask
+    _SHARD_COUNT = 16
+    
     def __init__(self, settings: Any):
         """Initialize stream processor with configuration."""
         self.settings = settings
-        self.active_streams: Dict[int, StreamContext] = {}
+        self._shards: Tuple[Dict[int, StreamContext], ...] = tuple(
+            {} for _ in range(self._SHARD_COUNT)
+        )
         self.rate_limiter = StreamRateLimiter()
         
-        # Configuration
-        self.enable_streaming = getattr(settings, 'enable_streaming_messages', True)
-        self.chunk_size = getattr(settings, 'stream_chunk_size', 500)
-        self.update_interval = getattr(settings, 'stream_update_interval', 1000)
-        self.max_messages = getattr(settings, 'max_stream_messages', 10)
+        # Deferred content flushes for users whose updates were rate limited
+        self._pending_flush: Dict[int, asyncio.TimerHandle] = {}
+        
+        # Scheduled edits keyed by (user_id, message_id); the edit sends the
+        # message's content as it is when the timer fires
+        self._edit_queue: Dict[Tuple[int, int], Tuple[StreamMessage, asyncio.TimerHandle]] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        
+        # Configuration, bound as plain attributes for the hot paths
+        self.config = StreamConfig.from_settings(settings)
+        self.enable_streaming = self.config.enable
+        self.chunk_size = self.config.chunk_size
+        self.update_interval = self.config.update_interval
+        self.max_messages = self.config.max_messages
+        
+        # Update type -> handler, so dispatch is a single dict lookup
+        self._update_handlers: Dict[str, Callable[[StreamContext, Any], Awaitable[None]]] = {
+            "tool_use": self._handle_tool_start,
+            "tool_result": self._handle_tool_complete,
+            "assistant": self._handle_assistant_update,
+            "progress": self._handle_progress_update,
+        }
     
     async def start_stream(self, user_id: int, chat_id: int, 
                           update: Update, session_id: Optional[str] = None) -> StreamContext:
@@ -42,10 +128,10 @@ class StreamProcessor:
             raise StreamingError("Streaming is disabled")
         
         # Clean up any existing stream for this user
-        await self.cleanup_stream(user_id)
+        self._cleanup_sync(user_id)
         
         # Create new stream context
-        context = StreamContext(
+        context = self._acquire_context(
             user_id=user_id,
             chat_id=chat_id,
             session_id=session_id,
@@ -54,7 +140,7 @@ class StreamProcessor:
             max_messages=self.max_messages
         )
         
-        self.active_streams[user_id] = context
+        self._shard(user_id)[user_id] = context
         
         # Send initial header message
         await self._send_header_message(context, update)
@@ -71,39 +157,33 @@ class StreamProcessor:
     async def _send_header_message(self, context: StreamContext, update: Update) -> None:
         """Send the initial header message."""
         if context.session_id:
-            session_info = f"Session: {self._escape_markdown(context.session_id[:8])}..."
+            session_info = f"Session: {escape_markdown(context.session_id[:8])}..."
         else:
             session_info = "New session"
-        header_text = f"🚀 *Claude Session Started* • {session_info}"
+        header_text = self._HEADER_PREFIX + session_info
         
         try:
             header_msg = await update.message.reply_text(
                 header_text,
-                parse_mode="Markdown",
+                parse_mode=_PARSE_MODE,
                 reply_to_message_id=update.message.message_id
             )
-            
-            context.add_message('header', header_text, header_msg)
-            
-        except Exception as e:
+        except TelegramError as e:
             logger.warning("Failed to send header message", error=str(e))
             raise StreamingError(f"Failed to initialize stream: {e}")
+        
+        context.add_message('header', header_text, header_msg)
     
     async def handle_stream_update(self, user_id: int, update_obj: Any) -> None:
         """Handle incoming stream updates from Claude."""
-        context = self.active_streams.get(user_id)
-        if not context or not context.is_active:
+        context = self._active(user_id)
+        if context is None:
             return
         
         try:
-            if update_obj.type == "tool_use":
-                await self._handle_tool_start(context, update_obj)
-            elif update_obj.type == "tool_result":
-                await self._handle_tool_complete(context, update_obj)
-            elif update_obj.type == "assistant" and update_obj.content:
-                await self._handle_content_update(context, update_obj.content)
-            elif update_obj.type == "progress":
-                await self._handle_progress_update(context, update_obj)
+            handler = self._update_handlers.get(update_obj.type)
+            if handler:
+                await handler(context, update_obj)
                 
         except Exception as e:
             logger.warning(
@@ -119,7 +199,7 @@ class StreamProcessor:
         tool_exec = context.start_tool(tool_name)
         
         # Send tool start message
-        tool_text = f"🔧 **Using {tool_name}**"
+        tool_text = self._TOOL_USE_FMT.format(tool_name)
         
         # Add input info if available
         if hasattr(update_obj, 'input') and update_obj.input:
@@ -127,12 +207,8 @@ class StreamProcessor:
             if input_info:
                 tool_text += f": {input_info}"
         
-        try:
-            tool_msg = await self._send_new_message(context, tool_text, 'tool')
-            tool_exec.message_id = tool_msg.message_id if tool_msg else None
-            
-        except Exception as e:
-            logger.warning("Failed to send tool start message", error=str(e))
+        tool_msg = await self._send_new_message(context, tool_text, 'tool')
+        tool_exec.message_id = tool_msg.message_id if tool_msg else None
     
     async def _handle_tool_complete(self, context: StreamContext, update_obj: Any) -> None:
         """Handle tool execution completion."""
@@ -150,64 +226,99 @@ class StreamProcessor:
             if is_error:
                 updated_text = f"{status_emoji} **{tool_name} failed**{duration_text}"
                 if error_msg:
-                    updated_text += f"\n_{error_msg[:100]}..._" if len(error_msg) > 100 else f"\n_{error_msg}_"
+                    tail = error_msg if len(error_msg) <= 100 else error_msg[:100] + "..."
+                    updated_text += f"\n_{tail}_"
             else:
                 updated_text = f"{status_emoji} **{tool_name} complete**{duration_text}"
             
-            try:
-                await self._update_message(context, tool_exec.message_id, updated_text, 'tool')
-            except Exception as e:
-                logger.warning("Failed to update tool completion message", error=str(e))
+            await self._update_message(context, tool_exec.message_id, updated_text, 'tool')
+    
+    async def _handle_assistant_update(self, context: StreamContext, update_obj: Any) -> None:
+        """Handle assistant text, ignoring updates without content."""
+        if update_obj.content:
+            await self._handle_content_update(context, update_obj.content)
     
     async def _handle_content_update(self, context: StreamContext, content: str) -> None:
         """Handle content streaming updates."""
         context.append_content(content)
+        if not context.has_buffer_chunk():
+            return
         
-        # Check if we should send a content update
-        if self.rate_limiter.should_update_content(context.user_id):
-            chunk = context.get_buffer_chunk()
-            if chunk:
-                await self._update_content_message(context, chunk)
+        user_id = context.user_id
+        if self.rate_limiter.should_update_content(user_id):
+            await self._flush_content(context)
+        elif user_id not in self._pending_flush:
+            # Rate limited: flush everything buffered by then in one update
+            delay = self.rate_limiter.time_until_next_update(user_id)
+            self._pending_flush[user_id] = asyncio.get_running_loop().call_later(
+                delay, self._flush_user, user_id
+            )
+    
+    def _flush_user(self, user_id: int) -> None:
+        """Timer callback that flushes content deferred by rate limiting."""
+        self._pending_flush.pop(user_id, None)
+        context = self._active(user_id)
+        if context is None or not context.has_buffer_chunk():
+            return
+        
+        if self.rate_limiter.should_update_content(user_id):
+            self._run_in_background(
+                self._flush_content_if_current(context, context.generation)
+            )
+    
+    def _run_in_background(self, coro: Any) -> None:
+        """Run a coroutine from a timer callback, keeping the task referenced."""
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _flush_content(self, context: StreamContext) -> None:
+        """Send all complete buffered chunks as a single content update."""
+        chunks = []
+        while (chunk := context.get_buffer_chunk()) is not None:
+            chunks.append(chunk)
+        if chunks:
+            await self._update_content_message(context, "".join(chunks))
+    
+    async def _flush_content_if_current(self, context: StreamContext,
+                                        generation: int) -> None:
+        """Flush content unless the pooled context was reset for a new session."""
+        if context.generation == generation:
+            await self._flush_content(context)
+    
+    def _cancel_pending_flush(self, user_id: int) -> None:
+        """Cancel a deferred content flush for a user."""
+        handle = self._pending_flush.pop(user_id, None)
+        if handle:
+            handle.cancel()
     
     async def _handle_progress_update(self, context: StreamContext, update_obj: Any) -> None:
         """Handle progress updates (typing indicators, etc.)."""
         # For now, we'll just log progress updates
         # In the future, we could show these as temporary status updates
-        progress_text = getattr(update_obj, 'content', 'Working...')
-        logger.debug("Progress update", user_id=context.user_id, progress=progress_text)
+        if _stdlib_logger.isEnabledFor(logging.DEBUG):
+            progress_text = getattr(update_obj, 'content', 'Working...')
+            logger.debug("Progress update", user_id=context.user_id, progress=progress_text)
     
     async def _update_content_message(self, context: StreamContext, chunk: str) -> None:
         """Update or create the main content message."""
         content_msg = context.get_message('content')
         
         if content_msg:
-            # Update existing content message
-            new_content = content_msg.content + chunk
-            try:
-                await self._update_message(context, content_msg.message_id, new_content, 'content')
-                content_msg.update_content(new_content)
-            except Exception as e:
-                logger.warning("Failed to update content message", error=str(e))
+            # Append the chunk locally; the full text is joined only when sent
+            content_msg.append_content(chunk)
+            if content_msg.telegram_message:
+                self._schedule_edit(context.user_id, content_msg)
         else:
             # Create new content message
-            content_text = f"🤖 **Claude Response:**\n\n{chunk}"
-            try:
-                content_msg = await self._send_new_message(context, content_text, 'content')
-            except Exception as e:
-                logger.warning("Failed to create content message", error=str(e))
+            await self._send_new_message(context, self._CONTENT_PREFIX + chunk, 'content')
     
     async def _send_new_message(self, context: StreamContext, text: str, 
                                message_type: str) -> Optional[StreamMessage]:
         """Send a new message in the stream."""
-        try:
-            # This is a placeholder - the actual message sending is handled
-            # by the MessageManager which has access to the bot instance
-            stream_msg = context.add_message(message_type, text)
-            return stream_msg
-            
-        except Exception as e:
-            logger.error("Failed to send new stream message", error=str(e))
-            return None
+        # This is a placeholder - the actual message sending is handled
+        # by the MessageManager which has access to the bot instance
+        return context.add_message(message_type, text)
     
     async def _update_message(self, context: StreamContext, message_id: int, 
                              new_text: str, message_type: str) -> None:
@@ -215,22 +326,65 @@ class StreamProcessor:
         stream_msg = context.get_message(message_type, message_id)
         if not stream_msg or not stream_msg.telegram_message:
             return
+        if new_text == stream_msg.sent_content and stream_msg.content_matches(new_text):
+            # Telegram already shows this text; skip the edit round-trip
+            return
+        
+        stream_msg.update_content(new_text)
+        self._schedule_edit(context.user_id, stream_msg)
+    
+    def _schedule_edit(self, user_id: int, stream_msg: StreamMessage) -> None:
+        """Schedule an edit so bursts of updates to a message become one API call."""
+        key = (user_id, stream_msg.message_id)
+        if key in self._edit_queue:
+            # The pending edit will pick up the latest content
+            return
+        
+        handle = asyncio.get_running_loop().call_later(
+            self.EDIT_DEBOUNCE_SECONDS, self._send_scheduled_edit, key
+        )
+        self._edit_queue[key] = (stream_msg, handle)
+    
+    def _send_scheduled_edit(self, key: Tuple[int, int]) -> None:
+        """Timer callback that sends a debounced edit."""
+        entry = self._edit_queue.pop(key, None)
+        if entry:
+            self._run_in_background(self._send_edit(entry[0]))
+    
+    async def _flush_edits(self, user_id: int) -> None:
+        """Send a user's debounced edits immediately."""
+        keys = [key for key in self._edit_queue if key[0] == user_id]
+        for key in keys:
+            stream_msg, handle = self._edit_queue.pop(key)
+            handle.cancel()
+            await self._send_edit(stream_msg)
+    
+    async def _send_edit(self, stream_msg: StreamMessage) -> None:
+        """Send a message's current content, recording it once Telegram shows it."""
+        text = stream_msg.content
+        if await self._edit_message(stream_msg, text):
+            stream_msg.sent_content = text
+    
+    async def _edit_message(self, stream_msg: StreamMessage, text: str) -> bool:
+        """Edit a sent message to show the given text.
         
+        Returns True if Telegram now shows that text.
+        """
         try:
             await stream_msg.telegram_message.edit_text(
-                new_text,
-                parse_mode="Markdown"
+                text,
+                parse_mode=_PARSE_MODE
             )
-            stream_msg.update_content(new_text)
+            return True
             
         except BadRequest as e:
             if "not modified" in str(e).lower():
                 # Message content is the same, ignore
-                pass
-            else:
-                logger.warning("Failed to edit message", error=str(e))
-        except Exception as e:
+                return True
+            logger.warning("Failed to edit message", error=str(e))
+        except TelegramError as e:
             logger.warning("Failed to update message", error=str(e))
+        return False
     
     def _format_tool_input(self, tool_name: str, tool_input: Dict) -> Optional[str]:
         """Format tool input for display."""
@@ -249,95 +403,129 @@ class StreamProcessor:
     async def finalize_stream(self, user_id: int, cost: float = 0.0, 
                              follow_up_suggestions: Optional[List[str]] = None) -> None:
         """Finalize the streaming session."""
-        context = self.active_streams.get(user_id)
+        context = self._shard(user_id).get(user_id)
         if not context:
             return
         
+        self._cancel_pending_flush(user_id)
+        
         try:
             # Flush any remaining content
             remaining_content = context.flush_buffer()
             if remaining_content:
                 await self._update_content_message(context, remaining_content)
             
-            # Send completion status
+            # Send completion status; failed edits are logged by _edit_message
             await self._send_completion_message(context, cost, follow_up_suggestions)
+            await self._flush_edits(user_id)
             
             # Mark as complete
             context.cleanup()
             context.total_cost = cost
             
-            logger.info(
-                "Finalized streaming session",
-                user_id=user_id,
-                session_summary=context.get_session_summary()
-            )
-            
-        except Exception as e:
-            logger.error("Failed to finalize stream", user_id=user_id, error=str(e))
+            # Only build the summary when the log line will be emitted
+            if _stdlib_logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Finalized streaming session",
+                    user_id=user_id,
+                    session_summary=context.get_session_summary()
+                )
+        finally:
+            # Release the stream even if finishing it failed
+            self._cleanup_sync(user_id)
     
     async def _send_completion_message(self, context: StreamContext, cost: float,
                                      follow_up_suggestions: Optional[List[str]]) -> None:
         """Send the final completion status message."""
         tools_count = len(context.tools)
-        duration = datetime.now() - context.start_time
-        duration_text = f"{duration.total_seconds():.1f}s"
-        
-        status_text = f"✅ **Session Complete** • Cost: ${cost:.4f} • Duration: {duration_text}"
+        status_text = self._COMPLETE_FMT.format(cost, context.elapsed_seconds())
         
         if tools_count > 0:
-            status_text += f" • {tools_count} tools used"
+            status_text += self._TOOLS_USED_FMT.format(tools_count)
         
         if follow_up_suggestions:
-            status_text += "\n\n💡 **What would you like to do next?**"
+            status_text += self._FOLLOW_UP_TEXT
         
-        try:
-            await self._send_new_message(context, status_text, 'status')
-        except Exception as e:
-            logger.warning("Failed to send completion message", error=str(e))
+        await self._send_new_message(context, status_text, 'status')
     
     async def cleanup_stream(self, user_id: int) -> None:
-        """Clean up a streaming session."""
-        if user_id in self.active_streams:
-            context = self.active_streams[user_id]
+        """Clean up a streaming session, waiting for its pending edits."""
+        await self._flush_edits(user_id)
+        self._cleanup_sync(user_id)
+    
+    def _cleanup_sync(self, user_id: int) -> None:
+        """Clean up a streaming session without waiting on Telegram."""
+        self._cancel_pending_flush(user_id)
+        self.rate_limiter.cleanup_user(user_id)
+        
+        # Edits still waiting on their debounce timer are sent right away
+        for key in [key for key in self._edit_queue if key[0] == user_id]:
+            self._edit_queue[key][1].cancel()
+            self._send_scheduled_edit(key)
+        
+        context = self._shard(user_id).pop(user_id, None)
+        if context is not None:
             context.cleanup()
-            del self.active_streams[user_id]
+            self._release_context(context)
             
             logger.debug("Cleaned up streaming session", user_id=user_id)
     
+    def _acquire_context(self, **kwargs: Any) -> StreamContext:
+        """Take a stream context from the pool, or create one if it is empty."""
+        try:
+            context = self._context_pool.pop()
+        except IndexError:
+            return StreamContext(**kwargs)
+        
+        context.reset(**kwargs)
+        return context
+    
+    def _release_context(self, context: StreamContext) -> None:
+        """Return a finished stream context to the pool."""
+        self._context_pool.append(context)
+    
+    def _shard(self, user_id: int) -> Dict[int, StreamContext]:
+        """Get the dict holding the user's active stream."""
+        return self._shards[user_id & (self._SHARD_COUNT - 1)]
+    
+    def _active(self, user_id: int) -> Optional[StreamContext]:
+        """Get the user's stream context only if it is still active."""
+        context = self._shard(user_id).get(user_id)
+        return context if context is not None and context.is_active else None
+    
     def get_stream_context(self, user_id: int) -> Optional[StreamContext]:
         """Get the current stream context for a user."""
-        return self.active_streams.get(user_id)
-    
-    def _escape_markdown(self, text: str) -> str:
-        """Escape special Markdown characters."""
-        if not text:
-            return ""
-        # Escape special markdown characters
-        escape_chars = ['*', '_', '`', '[', ']', '(', ')', '~', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-        for char in escape_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
+        return self._shard(user_id).get(user_id)
 
 
 class StreamRateLimiter:
     """Handles rate limiting for stream updates."""
     
+    __slots__ = ("last_content_update", "_min_interval")
+    
     def __init__(self):
         """Initialize rate limiter."""
-        self.last_content_update: Dict[int, datetime] = {}
-        self.min_content_interval = timedelta(seconds=1)  # Max 1 content update per second
+        self.last_content_update: Dict[int, float] = {}  # user_id -> time.monotonic()
+        self._min_interval = 1.0  # Max 1 content update per second
     
     def should_update_content(self, user_id: int) -> bool:
         """Check if content should be updated based on rate limits."""
-        now = datetime.now()
+        now = time.monotonic()
         last_update = self.last_content_update.get(user_id)
         
-        if not last_update or (now - last_update) >= self.min_content_interval:
+        if last_update is None or now - last_update >= self._min_interval:
             self.last_content_update[user_id] = now
             return True
         
         return False
     
+    def time_until_next_update(self, user_id: int) -> float:
+        """Get the seconds until the next content update is allowed."""
+        last_update = self.last_content_update.get(user_id)
+        if last_update is None:
+            return 0.0
+        return max(0.0, last_update + self._min_interval - time.monotonic())
+    
     def cleanup_user(self, user_id: int) -> None:
         """Clean up rate limiting data for a user."""
         self.last_content_update.pop(user_id, None)
\ No newline at end of file
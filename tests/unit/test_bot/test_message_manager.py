@@ -0,0 +1,297 @@
+"""Tests for the streaming message manager."""
+
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from telegram.error import RetryAfter
+
+from src.bot.models.stream_context import StreamContext
+from src.bot.utils import message_manager
+from src.bot.utils.message_manager import MessageManager
+from src.bot.utils.streaming import StreamProcessor
+from src.security.rate_limiter import RateLimitBucket
+
+
+@pytest.fixture
+def stream_processor():
+    """Create a stream processor with default settings."""
+    return StreamProcessor(Mock(spec=[]))
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limits(monkeypatch):
+    """Give each test its own copy of the process-wide rate limit buckets."""
+    monkeypatch.setattr(
+        MessageManager,
+        "_global_bucket",
+        message_manager._create_bucket(MessageManager.GLOBAL_UPDATES_PER_SECOND),
+    )
+    monkeypatch.setattr(MessageManager, "_chat_buckets", {})
+
+
+@pytest.fixture
+def manager(stream_processor):
+    """Create a message manager."""
+    return MessageManager(stream_processor)
+
+
+@pytest.fixture
+def context(stream_processor):
+    """Register an active stream context for user 123."""
+    context = StreamContext(user_id=123, chat_id=456, chunk_size=5)
+    stream_processor._shard(123)[123] = context
+    return context
+
+
+def make_telegram_message():
+    """Create a mock Telegram message."""
+    message = Mock()
+    message.edit_text = AsyncMock()
+    return message
+
+
+class TestUpdateQueue:
+    """Test queueing of message updates."""
+
+    async def test_updates_to_same_message_are_coalesced(self, manager, context):
+        """Test that only the latest update per message is kept."""
+        tool_msg = context.add_message("tool", "Tool", make_telegram_message())
+
+        await manager.update_stream_message(123, tool_msg.message_id, "one", "tool")
+        await manager.update_stream_message(123, tool_msg.message_id, "two", "tool")
+
+        pending = list(manager.pending_updates[123].values())
+        assert len(pending) == 1
+        assert pending[0]["new_content"] == "two"
+
+    async def test_coalesced_content_keeps_all_chunks(self, manager, context):
+        """Test that queued content updates build on each other."""
+        context.add_message("content", "Start", make_telegram_message())
+
+        await manager.handle_content_stream(123, "aaaaa")
+        await manager.handle_content_stream(123, "bbbbb")
+
+        pending = list(manager.pending_updates[123].values())
+        assert len(pending) == 1
+        assert pending[0]["new_content"] == "Startaaaaabbbbb"
+
+    async def test_unchanged_content_is_not_queued(self, manager, context):
+        """Test that updates matching the current text are skipped."""
+        tool_msg = context.add_message("tool", "Tool", make_telegram_message())
+
+        await manager.update_stream_message(123, tool_msg.message_id, "new", "tool")
+        await manager.update_stream_message(123, tool_msg.message_id, "Tool", "tool")
+
+        assert 123 not in manager.pending_updates
+
+    async def test_flush_applies_pending_updates(self, manager, context):
+        """Test that flushing edits each queued message once."""
+        telegram_msg = make_telegram_message()
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+
+        await manager.update_stream_message(123, tool_msg.message_id, "one", "tool")
+        await manager.update_stream_message(123, tool_msg.message_id, "two", "tool")
+        await manager._flush_pending_updates(123)
+
+        telegram_msg.edit_text.assert_awaited_once_with("two", parse_mode="Markdown")
+        assert tool_msg.content == "two"
+        assert 123 not in manager.pending_updates
+
+    async def test_finalize_sends_remaining_content(self, manager, context):
+        """Test that text left in the buffer reaches Telegram on finalize."""
+        telegram_msg = make_telegram_message()
+        content_msg = context.add_message("content", "", telegram_msg)
+        manager._send_completion_message = AsyncMock()
+
+        for chunk in ("hello", " world", "!!"):
+            await manager.handle_content_stream(123, chunk)
+        await manager.finalize_stream(123)
+
+        telegram_msg.edit_text.assert_awaited_with(
+            "hello world!!", parse_mode="Markdown"
+        )
+        assert content_msg.content == "hello world!!"
+
+    async def test_finalize_retries_final_content_after_rate_limit(
+        self, manager, stream_processor, context
+    ):
+        """Test that the final edit waits out flood control and is sent."""
+        telegram_msg = make_telegram_message()
+        telegram_msg.edit_text.side_effect = [RetryAfter(0), None]
+        context.add_message("content", "", telegram_msg)
+        context.append_content("tail")
+        manager._send_completion_message = AsyncMock()
+
+        await manager.finalize_stream(123)
+
+        assert telegram_msg.edit_text.await_count == 2
+        telegram_msg.edit_text.assert_awaited_with("tail", parse_mode="Markdown")
+        manager._send_completion_message.assert_awaited_once()
+        assert stream_processor.get_stream_context(123) is None
+
+    async def test_finalize_releases_stream_when_rate_limited(
+        self, manager, stream_processor, context
+    ):
+        """Test that the stream is released even if flood control persists."""
+        telegram_msg = make_telegram_message()
+        telegram_msg.edit_text.side_effect = RetryAfter(0)
+        context.add_message("content", "", telegram_msg)
+        context.append_content("tail")
+        manager._send_completion_message = AsyncMock(side_effect=RuntimeError("boom"))
+
+        await manager.finalize_stream(123)
+
+        assert telegram_msg.edit_text.await_count == 2
+        assert stream_processor.get_stream_context(123) is None
+        assert not context.is_active
+
+
+class TestToolMessages:
+    """Test tool status messages."""
+
+    async def test_tool_failure_text(self, manager, context):
+        """Test the text of a failed tool update."""
+        tool_msg = context.add_message("tool", "Tool", make_telegram_message())
+        context.start_tool("Bash").message_id = tool_msg.message_id
+
+        await manager.handle_tool_complete(
+            123, "Bash", success=False, error="x" * 120, execution_time_ms=42
+        )
+
+        pending = list(manager.pending_updates[123].values())
+        assert pending[0]["new_content"] == (
+            "❌ *Bash failed* (42ms)\n`" + "x" * 100 + "\\.\\.\\.`"
+        )
+
+    async def test_tool_success_text(self, manager, context):
+        """Test the text of a completed tool update."""
+        tool_msg = context.add_message("tool", "Tool", make_telegram_message())
+        context.start_tool("my_tool").message_id = tool_msg.message_id
+
+        await manager.handle_tool_complete(123, "my_tool")
+
+        pending = list(manager.pending_updates[123].values())
+        assert pending[0]["new_content"] == "✅ *my\\_tool complete*"
+
+
+class TestUpdateDispatch:
+    """Test rate-limited dispatch of queued updates."""
+
+    async def test_take_ready_updates_respects_chat_limit(
+        self, manager, stream_processor, context
+    ):
+        """Test that each chat gets at most one update per second."""
+        other = StreamContext(user_id=789, chat_id=999)
+        stream_processor._shard(789)[789] = other
+        first = context.add_message("tool", "Tool", make_telegram_message())
+        second = context.add_message("tool", "Tool", make_telegram_message())
+        third = other.add_message("tool", "Tool", make_telegram_message())
+
+        await manager.update_stream_message(123, first.message_id, "a", "tool")
+        await manager.update_stream_message(123, second.message_id, "b", "tool")
+        await manager.update_stream_message(789, third.message_id, "c", "tool")
+
+        batch = manager._take_ready_updates()
+        assert [(user_id, chat_id) for user_id, chat_id, _ in batch] == [
+            (123, 456),
+            (789, 999),
+        ]
+        assert manager._take_ready_updates() == []
+        assert list(manager.pending_updates) == [123]
+        assert manager._next_dispatch_delay() > 0
+
+    def test_rate_limits_are_shared_between_managers(self, manager, stream_processor):
+        """Test that managers created per message use the same buckets."""
+        other = MessageManager(stream_processor)
+
+        assert other._global_bucket is manager._global_bucket
+        assert other._get_chat_bucket(456) is manager._get_chat_bucket(456)
+
+    async def test_finished_stream_drops_refilled_chat_bucket(self, manager, context):
+        """Test that cleanup forgets chat buckets once they have refilled."""
+        manager._get_chat_bucket(456).consume()
+        busy = manager._get_chat_bucket(999)
+        busy.tokens = -5
+        # The finished chat's bucket has had time to refill
+        manager._chat_buckets[456].last_update -= timedelta(seconds=2)
+
+        await manager._cleanup_user_streaming(123)
+
+        assert list(manager._chat_buckets) == [999]
+        assert manager._chat_buckets[999] is busy
+
+    async def test_retry_after_waits_requested_time(self, manager, context):
+        """Test that a flood-control error pauses the chat for retry_after."""
+        telegram_msg = make_telegram_message()
+        telegram_msg.edit_text.side_effect = RetryAfter(2)
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+        update_data = {
+            "action": "update_content",
+            "stream_msg": tool_msg,
+            "new_content": "done",
+        }
+
+        await manager._dispatch_update(123, 456, update_data)
+
+        assert 1.9 < manager._get_chat_bucket(456).get_wait_time() <= 2.0
+        assert list(manager.pending_updates[123].values()) == [update_data]
+
+
+class TestFormatToolInput:
+    """Test tool input previews."""
+
+    def test_file_tool_shows_path(self, manager):
+        """Test that file tools show the file path."""
+        assert manager._format_tool_input("Read", {"file_path": "a.py"}) == "`a.py`"
+        assert manager._format_tool_input("edit", {"path": "b.py"}) == "`b.py`"
+
+    def test_bash_command_is_truncated(self, manager):
+        """Test that long commands are truncated."""
+        assert manager._format_tool_input("Bash", {"command": "ls"}) == "`ls`"
+        assert manager._format_tool_input("Bash", {"command": "x" * 60}) == (
+            "`" + "x" * 50 + "...`"
+        )
+
+    def test_unknown_tool(self, manager):
+        """Test that other tools have no preview."""
+        assert manager._format_tool_input("Grep", {"pattern": "foo"}) is None
+
+
+class TestUpdateDispatcher:
+    """Test the background update dispatcher."""
+
+    async def test_dispatcher_sends_queued_update_promptly(self, manager, context):
+        """Test that queueing work starts the dispatcher, which exits when idle."""
+        telegram_msg = make_telegram_message()
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+
+        await manager.update_stream_message(123, tool_msg.message_id, "done", "tool")
+        await asyncio.sleep(0.05)
+
+        telegram_msg.edit_text.assert_awaited_once_with("done", parse_mode="Markdown")
+        assert 123 not in manager.pending_updates
+        assert manager._dispatcher_task.done()
+
+    async def test_dispatcher_waits_for_rate_limit(self, manager, context):
+        """Test that rate-limited updates are sent once the chat allows it."""
+        manager._chat_buckets[456] = RateLimitBucket(
+            capacity=1, tokens=1, last_update=datetime.utcnow(), refill_rate=20
+        )
+        first_msg = make_telegram_message()
+        second_msg = make_telegram_message()
+        first = context.add_message("tool", "Tool", first_msg)
+        second = context.add_message("tool", "Tool", second_msg)
+
+        await manager.update_stream_message(123, first.message_id, "one", "tool")
+        await manager.update_stream_message(123, second.message_id, "two", "tool")
+        await asyncio.sleep(0.01)
+
+        first_msg.edit_text.assert_awaited_once()
+        second_msg.edit_text.assert_not_awaited()
+
+        await asyncio.sleep(0.2)
+
+        second_msg.edit_text.assert_awaited_once_with("two", parse_mode="Markdown")
+        assert manager._dispatcher_task.done()
@@ -0,0 +1,172 @@
+"""Tests for stream context data structures."""
+
+import pytest
+
+from src.bot.models.stream_context import StreamContext
+
+
+@pytest.fixture
+def context():
+    """Create a stream context."""
+    return StreamContext(user_id=123, chat_id=456, chunk_size=10)
+
+
+class TestStreamContextMessages:
+    """Test stream message tracking."""
+
+    def test_get_message_returns_latest_of_type(self, context):
+        """Test that the latest message of a type is returned."""
+        context.add_message("header", "Header")
+        first = context.add_message("tool", "Tool 1")
+        second = context.add_message("tool", "Tool 2")
+
+        assert context.get_message("tool") is second
+        assert context.get_message("tool", first.message_id) is first
+        assert context.get_message("header").content == "Header"
+        assert context.get_message("header", first.message_id) is None
+        assert context.get_message_by_id(first.message_id) is first
+
+    def test_get_message_missing_type(self, context):
+        """Test lookup of a type that was never added."""
+        context.add_message("header", "Header")
+
+        assert context.get_message("content") is None
+
+    def test_add_message_tracks_type_ids(self, context):
+        """Test that typed message ids are tracked."""
+        header = context.add_message("header", "Header")
+        content = context.add_message("content", "Content")
+
+        assert context.header_message_id == header.message_id
+        assert context.content_message_id == content.message_id
+
+    def test_messages_final_after_cleanup(self, context):
+        """Test that cleanup marks every message as final."""
+        first = context.add_message("header", "Header")
+        second = context.add_message("content", "Content")
+        assert not first.is_final
+
+        context.cleanup()
+
+        assert not context.is_active
+        assert first.is_final
+        assert second.is_final
+
+    def test_reset_for_new_session(self, context):
+        """Test that reset clears the context but keeps old messages final."""
+        old_msg = context.add_message("header", "Header")
+        context.start_tool("Bash")
+        context.append_content("leftover text")
+        context.cleanup()
+
+        context.reset(user_id=7, chat_id=8, session_id="abc", chunk_size=20)
+
+        assert (context.user_id, context.chat_id, context.session_id) == (7, 8, "abc")
+        assert context.chunk_size == 20
+        assert context.is_active
+        assert context.messages == []
+        assert context.tools == {}
+        assert context.header_message_id is None
+        assert context.get_message("header") is None
+        assert context.flush_buffer() == ""
+        assert old_msg.is_final
+
+        new_msg = context.add_message("header", "Header")
+        assert new_msg.message_id == 1
+        assert not new_msg.is_final
+
+
+class TestStreamContextBuffer:
+    """Test content buffering."""
+
+    def test_buffer_chunking(self, context):
+        """Test that full chunks are returned and the rest is kept."""
+        context.append_content("hello ")
+        assert context.get_buffer_chunk() is None
+
+        context.append_content("world, again")
+        assert context.get_buffer_chunk() == "hello worl"
+        assert context.get_buffer_chunk() is None
+        assert context.flush_buffer() == "d, again"
+        assert context.flush_buffer() == ""
+
+    def test_buffer_does_not_split_characters(self, context):
+        """Test that multi-byte characters are never split across chunks."""
+        text = "héllo wörld 🤖🤖 done"
+        context.append_content(text)
+
+        chunks = []
+        while (chunk := context.get_buffer_chunk()) is not None:
+            chunks.append(chunk)
+        chunks.append(context.flush_buffer())
+
+        assert "".join(chunks) == text
+
+    def test_buffer_interleaved_appends(self, context):
+        """Test reading chunks while more content keeps arriving."""
+        received = []
+        for i in range(50):
+            context.append_content(f"part {i} ✓ ")
+            while (chunk := context.get_buffer_chunk()) is not None:
+                received.append(chunk)
+        received.append(context.flush_buffer())
+
+        assert "".join(received) == "".join(f"part {i} ✓ " for i in range(50))
+        assert context.flush_buffer() == ""
+
+    def test_buffer_chunk_smaller_than_character(self):
+        """Test chunking when a single character exceeds the chunk size."""
+        context = StreamContext(user_id=1, chat_id=1, chunk_size=2)
+        context.append_content("🤖a")
+
+        assert context.get_buffer_chunk() == "🤖"
+        assert context.flush_buffer() == "a"
+
+
+class TestStreamMessage:
+    """Test StreamMessage behaviour."""
+
+    def test_content_matches(self, context):
+        """Test comparing message content against new text."""
+        msg = context.add_message("tool", "Using Bash")
+
+        assert msg.content_matches("Using Bash")
+        assert not msg.content_matches("Using Read")
+
+        msg.update_content("Bash complete")
+        assert msg.content_matches("Bash complete")
+        assert not msg.content_matches("Using Bash")
+
+    def test_append_content(self, context):
+        """Test that appended chunks are joined into the content."""
+        msg = context.add_message("content", "Start")
+
+        msg.append_content(" one")
+        msg.append_content(" two")
+
+        assert msg.content == "Start one two"
+        assert msg.content_parts == ["Start one two"]
+        assert msg.content_matches("Start one two")
+        assert not msg.content_matches("Start one")
+
+
+class TestToolExecution:
+    """Test tool execution tracking."""
+
+    def test_complete_tool_records_duration(self, context):
+        """Test that completing a tool records its duration."""
+        tool_exec = context.start_tool("Bash")
+        assert tool_exec.duration_ms is None
+
+        completed = context.complete_tool("Bash", success=False, error="boom")
+
+        assert completed is tool_exec
+        assert tool_exec.status == "error"
+        assert tool_exec.error_message == "boom"
+        assert tool_exec.duration_ms is not None
+        assert tool_exec.duration_ms >= 0
+        assert tool_exec.execution_time_ms == tool_exec.duration_ms
+
+    def test_complete_unknown_tool(self, context):
+        """Test completing a tool that was never started."""
+        assert context.complete_tool("Read") is None
@@ -0,0 +1,402 @@
+"""Tests for the stream processor."""
+
+import asyncio
+import logging
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+import structlog
+from telegram.error import TelegramError
+
+from src.bot.models.stream_context import StreamContext
+from src.bot.utils.streaming import (
+    StreamConfig,
+    StreamProcessor,
+    StreamRateLimiter,
+    escape_markdown,
+)
+
+
+@pytest.fixture
+def processor():
+    """Create a stream processor with default settings."""
+    return StreamProcessor(Mock(spec=[]))
+
+
+@pytest.fixture
+def context(processor):
+    """Register an active stream context for user 123."""
+    context = StreamContext(user_id=123, chat_id=456, chunk_size=5)
+    processor._shard(123)[123] = context
+    return context
+
+
+@pytest.fixture
+def stdlib_logging():
+    """Configure structlog on top of stdlib logging, as the application does."""
+    structlog.configure(
+        processors=[
+            structlog.stdlib.filter_by_level,
+            structlog.stdlib.add_log_level,
+            structlog.dev.ConsoleRenderer(colors=False),
+        ],
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        wrapper_class=structlog.stdlib.BoundLogger,
+    )
+    stdlib_logger = logging.getLogger("src.bot.utils.streaming")
+    original_level = stdlib_logger.level
+    yield stdlib_logger
+    stdlib_logger.setLevel(original_level)
+    structlog.reset_defaults()
+
+
+class TestStreamConfig:
+    """Test streaming configuration."""
+
+    def test_defaults_when_settings_missing(self, processor):
+        """Test that missing settings fall back to defaults."""
+        assert processor.config == StreamConfig()
+        assert processor.enable_streaming is True
+        assert processor.chunk_size == 500
+
+    def test_values_from_settings(self):
+        """Test that streaming settings are read from the settings object."""
+        settings = Mock(
+            enable_streaming_messages=False,
+            stream_chunk_size=200,
+            stream_update_interval=2000,
+            max_stream_messages=5,
+        )
+
+        processor = StreamProcessor(settings)
+
+        assert processor.config == StreamConfig(False, 200, 2000, 5)
+        assert processor.chunk_size == 200
+        assert processor.max_messages == 5
+
+
+class TestEscapeMarkdown:
+    """Test Markdown escaping."""
+
+    def test_escape_special_characters(self):
+        """Test that special characters are backslash-escaped."""
+        assert escape_markdown("abc-123_x") == "abc\\-123\\_x"
+        assert escape_markdown("(a)!") == "\\(a\\)\\!"
+        assert escape_markdown("my_file.py") == "my\\_file\\.py"
+        assert escape_markdown("*[a](b)*") == "\\*\\[a\\]\\(b\\)\\*"
+
+    def test_escape_plain_and_empty_text(self):
+        """Test that text without special characters is unchanged."""
+        assert escape_markdown("session") == "session"
+        assert escape_markdown("") == ""
+
+
+class TestStatusMessages:
+    """Test the text of stream status messages."""
+
+    async def test_completion_message(self, processor, context):
+        """Test the completion summary text."""
+        context.start_tool("Bash")
+        context.start_tool("Read")
+
+        await processor._send_completion_message(context, 0.25, ["next"])
+
+        status = context.get_message("status").content
+        assert status.startswith("✅ **Session Complete** • Cost: $0.2500 • Duration: ")
+        assert "s • 2 tools used\n\n💡" in status
+
+    async def test_tool_start_message(self, processor, context):
+        """Test the tool start text."""
+        update_obj = Mock(type="tool_use", input={"command": "ls"})
+        update_obj.name = "Bash"
+
+        await processor.handle_stream_update(123, update_obj)
+
+        assert context.get_message("tool").content == "🔧 **Using Bash**: `ls`"
+
+
+class TestStreamRateLimiter:
+    """Test content update rate limiting."""
+
+    def test_first_update_allowed_then_limited(self):
+        """Test that updates within the interval are refused."""
+        limiter = StreamRateLimiter()
+
+        assert limiter.should_update_content(1)
+        assert not limiter.should_update_content(1)
+        assert limiter.should_update_content(2)
+
+    def test_update_allowed_after_interval(self):
+        """Test that updates are allowed again after the interval."""
+        limiter = StreamRateLimiter()
+        limiter._min_interval = 0.0
+
+        assert limiter.should_update_content(1)
+        assert limiter.should_update_content(1)
+
+    def test_cleanup_user(self):
+        """Test that cleanup forgets the user's last update."""
+        limiter = StreamRateLimiter()
+        limiter.should_update_content(1)
+
+        limiter.cleanup_user(1)
+
+        assert limiter.should_update_content(1)
+
+
+class TestContentUpdates:
+    """Test buffering and flushing of streamed content."""
+
+    async def test_rate_limited_content_is_flushed_later(self, processor, context):
+        """Test that content held back by the rate limit is sent in one update."""
+        processor.rate_limiter._min_interval = 0.05
+
+        for text in ("aaaaa", "bbbbb", "ccccc"):
+            await processor.handle_stream_update(
+                123, Mock(type="assistant", content=text)
+            )
+
+        content_msg = context.get_message("content")
+        assert content_msg.content == "🤖 **Claude Response:**\n\naaaaa"
+        assert 123 in processor._pending_flush
+
+        await asyncio.sleep(0.1)
+
+        assert content_msg.content == "🤖 **Claude Response:**\n\naaaaabbbbbccccc"
+        assert not processor._pending_flush
+
+    async def test_content_message_edited_with_full_text(self, processor, context):
+        """Test that a sent content message is edited to the accumulated text."""
+        telegram_msg = Mock()
+        telegram_msg.edit_text = AsyncMock()
+        content_msg = context.add_message("content", "Start:", telegram_msg)
+
+        processor.EDIT_DEBOUNCE_SECONDS = 0.01
+
+        await processor._update_content_message(context, " one")
+        await processor._update_content_message(context, " two")
+        telegram_msg.edit_text.assert_not_awaited()
+        await asyncio.sleep(0.05)
+
+        telegram_msg.edit_text.assert_awaited_once_with(
+            "Start: one two", parse_mode="Markdown"
+        )
+        assert content_msg.content == "Start: one two"
+
+    async def test_cleanup_sends_pending_edits(self, processor, context):
+        """Test that debounced edits are sent when the stream is cleaned up."""
+        telegram_msg = Mock()
+        telegram_msg.edit_text = AsyncMock()
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+
+        await processor._update_message(context, tool_msg.message_id, "one", "tool")
+        await processor._update_message(context, tool_msg.message_id, "two", "tool")
+        await processor.cleanup_stream(123)
+
+        telegram_msg.edit_text.assert_awaited_once_with("two", parse_mode="Markdown")
+        assert not processor._edit_queue
+
+    async def test_unchanged_text_is_not_edited(self, processor, context):
+        """Test that updating a message to its current text sends no edit."""
+        telegram_msg = Mock()
+        telegram_msg.edit_text = AsyncMock()
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+
+        await processor._update_message(context, tool_msg.message_id, "Tool", "tool")
+
+        assert not processor._edit_queue
+        await processor.cleanup_stream(123)
+        telegram_msg.edit_text.assert_not_awaited()
+
+    async def test_failed_edit_is_retried(self, processor, context):
+        """Test that text whose edit failed is sent again on the next update."""
+        telegram_msg = Mock()
+        telegram_msg.edit_text = AsyncMock(side_effect=[TelegramError("timeout"), None])
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+
+        await processor._update_message(context, tool_msg.message_id, "done", "tool")
+        await processor._flush_edits(123)
+        assert tool_msg.sent_content == "Tool"
+
+        await processor._update_message(context, tool_msg.message_id, "done", "tool")
+        await processor._flush_edits(123)
+
+        assert telegram_msg.edit_text.await_count == 2
+        assert tool_msg.sent_content == "done"
+
+    async def test_cleanup_cancels_pending_flush(self, processor, context):
+        """Test that cleaning up a stream cancels its deferred flush."""
+        for text in ("aaaaa", "bbbbb"):
+            await processor.handle_stream_update(
+                123, Mock(type="assistant", content=text)
+            )
+        handle = processor._pending_flush[123]
+
+        await processor.cleanup_stream(123)
+
+        assert handle.cancelled()
+        assert not processor._pending_flush
+
+
+class TestContextPool:
+    """Test reuse of finished stream contexts."""
+
+    async def test_cleaned_up_context_is_reused(self, processor, context):
+        """Test that a released context is handed out again."""
+        StreamProcessor._context_pool.clear()
+
+        await processor.cleanup_stream(123)
+        reused = processor._acquire_context(user_id=7, chat_id=8)
+
+        assert reused is context
+        assert (reused.user_id, reused.chat_id) == (7, 8)
+        assert reused.is_active
+        assert processor._acquire_context(user_id=9, chat_id=10) is not context
+
+    async def test_deferred_flush_skips_reused_context(self, processor, context):
+        """Test that a flush started for a finished stream leaves its successor alone."""
+        StreamProcessor._context_pool.clear()
+        context.append_content("aaaaa")
+
+        processor._flush_user(123)
+        processor._cleanup_sync(123)
+        reused = processor._acquire_context(user_id=7, chat_id=8, chunk_size=5)
+        reused.append_content("bbbbb")
+        await asyncio.sleep(0)
+
+        assert reused is context
+        assert reused.get_message("content") is None
+        assert reused.flush_buffer() == "bbbbb"
+
+
+class TestActiveStreams:
+    """Test lookup of active stream contexts."""
+
+    def test_streams_are_sharded_by_user(self, processor):
+        """Test that users are stored in separate shards and found again."""
+        first = StreamContext(user_id=1, chat_id=1)
+        second = StreamContext(user_id=17, chat_id=2)
+        processor._shard(1)[1] = first
+        processor._shard(2)[2] = StreamContext(user_id=2, chat_id=3)
+        processor._shard(17)[17] = second
+
+        assert processor._shard(1) is processor._shard(17)
+        assert processor._shard(1) is not processor._shard(2)
+        assert processor.get_stream_context(1) is first
+        assert processor.get_stream_context(17) is second
+        assert processor.get_stream_context(33) is None
+
+
+class TestToolMessages:
+    """Test tool status messages."""
+
+    async def test_tool_error_is_truncated(self, processor, context):
+        """Test that long tool errors are cut to 100 characters."""
+        telegram_msg = Mock()
+        telegram_msg.edit_text = AsyncMock()
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+        context.start_tool("Bash").message_id = tool_msg.message_id
+
+        update_obj = Mock(type="tool_result", tool_name="Bash", is_error=True)
+        update_obj.error = "e" * 150
+        await processor.handle_stream_update(123, update_obj)
+
+        assert tool_msg.content.startswith("❌ **Bash failed**")
+        assert tool_msg.content.endswith("\n_" + "e" * 100 + "..._")
+
+    async def test_short_tool_error_is_kept(self, processor, context):
+        """Test that short tool errors are shown in full."""
+        tool_msg = context.add_message("tool", "Tool", Mock(edit_text=AsyncMock()))
+        context.start_tool("Bash").message_id = tool_msg.message_id
+
+        update_obj = Mock(type="tool_result", tool_name="Bash", is_error=True)
+        update_obj.error = "not found"
+        await processor.handle_stream_update(123, update_obj)
+
+        assert tool_msg.content.endswith("\n_not found_")
+
+
+class TestUpdateDispatch:
+    """Test routing of stream updates."""
+
+    async def test_unknown_and_empty_updates_are_ignored(self, processor, context):
+        """Test that unknown types and empty assistant text do nothing."""
+        await processor.handle_stream_update(123, Mock(type="system", content="x"))
+        await processor.handle_stream_update(123, Mock(type="assistant", content=""))
+
+        assert context.messages == []
+        assert context.flush_buffer() == ""
+
+    async def test_inactive_stream_is_ignored(self, processor, context):
+        """Test that updates for a finished stream are dropped."""
+        context.cleanup()
+
+        await processor.handle_stream_update(123, Mock(type="assistant", content="hi"))
+
+        assert context.flush_buffer() == ""
+
+
+class TestFinalizeStream:
+    """Test finishing a stream."""
+
+    @pytest.mark.parametrize("level, built", [(logging.INFO, 1), (logging.WARNING, 0)])
+    async def test_summary_built_only_when_logged(
+        self, processor, context, stdlib_logging, level, built
+    ):
+        """Test that the session summary is built only if INFO is emitted."""
+        stdlib_logging.setLevel(level)
+
+        with patch.object(
+            StreamContext, "get_session_summary", return_value={}
+        ) as get_summary:
+            await processor.finalize_stream(123, cost=0.5)
+
+        assert get_summary.call_count == built
+        assert not context.is_active
+        assert context.total_cost == 0.5
+        assert processor.get_stream_context(123) is None
+
+    async def test_stream_released_when_finalizing_fails(self, processor, context):
+        """Test that a failure while finishing still unregisters the stream."""
+        processor.rate_limiter.should_update_content(123)
+        processor._send_completion_message = AsyncMock(side_effect=RuntimeError("boom"))
+
+        with pytest.raises(RuntimeError):
+            await processor.finalize_stream(123)
+
+        assert processor.get_stream_context(123) is None
+        assert not context.is_active
+        assert 123 not in processor.rate_limiter.last_content_update
+
+    async def test_progress_update_with_stdlib_logger(
+        self, processor, context, stdlib_logging, caplog
+    ):
+        """Test that progress updates log cleanly with the app's logger setup."""
+        stdlib_logging.setLevel(logging.DEBUG)
+
+        with caplog.at_level(logging.DEBUG, logger=stdlib_logging.name):
+            await processor.handle_stream_update(
+                123, Mock(type="progress", content="Working")
+            )
+
+        assert "Progress update" in caplog.text
+        assert "Failed to handle stream update" not in caplog.text
+
+    async def test_start_stream_sends_previous_pending_edits(
+        self, processor, context
+    ):
+        """Test that restarting a stream hands off the old stream's edits."""
+        telegram_msg = Mock()
+        telegram_msg.edit_text = AsyncMock()
+        tool_msg = context.add_message("tool", "Tool", telegram_msg)
+        await processor._update_message(context, tool_msg.message_id, "done", "tool")
+        update = Mock()
+        update.message.reply_text = AsyncMock()
+
+        new_context = await processor.start_stream(123, 456, update)
+        await asyncio.sleep(0)
+
+        telegram_msg.edit_text.assert_awaited_once_with("done", parse_mode="Markdown")
+        assert not processor._edit_queue
+        assert processor.get_stream_context(123) is new_context
+        assert new_context.is_active